@@ -1,15 +1,24 @@
 from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+import redis.asyncio as redis
+from pymongo import ReturnDocument, UpdateOne
+from bson import Binary
+import zstandard as zstd
 import os
+import asyncio
 import logging
+import time
+from collections import OrderedDict
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import Dict, List, Optional
-import uuid
+from typing import Any, Dict, List, Optional, Set, Union
+import secrets
 from datetime import datetime, timezone
-import json
+import orjson
+import msgspec
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -19,19 +28,63 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Redis connection, optional: with REDIS_URL set, live session events are
+# relayed between workers over pub/sub so a session can span workers
+redis_url = os.environ.get('REDIS_URL')
+redis_client = redis.from_url(redis_url) if redis_url else None
+
 # Create the main app
-app = FastAPI(title="CodeSphere API")
+app = FastAPI(title="CodeSphere API", default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
 # Configure logging
+# Timestamps are left to the process supervisor, as with uvicorn's own logs
 logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    level=os.environ.get('LOG_LEVEL', 'WARNING'),
+    format='%(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+# How often dirty session state is written back to MongoDB (seconds)
+FLUSH_INTERVAL = 0.5
+# Membership changes within this window share one participants_update (seconds)
+PARTICIPANTS_UPDATE_DELAY = 0.1
+# Frames buffered per socket before the client is dropped as too slow
+SEND_QUEUE_SIZE = 256
+# How long a session document read from MongoDB is reused (seconds)
+SESSION_CACHE_TTL = 30
+# Most session documents kept in that cache; least recently used go first
+SESSION_CACHE_SIZE = 1024
+# Redis channel per session, channel announcing flushed sessions, and hashes
+# of each session's participants and live code/language across all workers
+SESSION_CHANNEL_PREFIX = "s:"
+FLUSHED_CHANNEL = "sessions:flushed"
+PARTICIPANTS_KEY_PREFIX = "p:"
+STATE_KEY_PREFIX = "st:"
+# How long live state outlives the last edit; MongoDB has it by then (seconds)
+SESSION_STATE_TTL = 3600
+# Workers refresh their participants in Redis this often; entries not
+# refreshed within PARTICIPANT_TTL belong to a dead worker (seconds)
+PARTICIPANT_HEARTBEAT = 10
+PARTICIPANT_TTL = 30
+# Pause before listening again after the pub/sub connection fails (seconds)
+PUBSUB_RETRY_DELAY = 1
+
+# Session code is stored zstd-compressed in `code_z`; documents written
+# before that keep it as a plain `code` string
+code_compressor = zstd.ZstdCompressor(level=3)
+code_decompressor = zstd.ZstdDecompressor()
+
+def compress_code(code: str) -> Binary:
+    return Binary(code_compressor.compress(code.encode()))
+
+def load_code(session: dict) -> str:
+    if "code_z" in session:
+        return code_decompressor.decompress(session["code_z"]).decode()
+    return session.get("code", "")
+
 # ============ Models ============
 
 class SessionCreate(BaseModel):
@@ -49,98 +102,696 @@ class Participant(BaseModel):
     username: str
     joined_at: str
 
+# Client -> server WebSocket messages, decoded by their "type" tag
+
+class ClientMessage(msgspec.Struct, tag_field="type"):
+    pass
+
+class Join(ClientMessage, tag="join"):
+    username: Optional[str] = None
+
+class CodeChange(ClientMessage, tag="code_change"):
+    code: str = ""
+
+class LanguageChange(ClientMessage, tag="language_change"):
+    language: str = "javascript"
+
+class CursorUpdate(ClientMessage, tag="cursor_update"):
+    position: Any = None
+    username: Optional[str] = None
+
+class WebRTCSignal(ClientMessage):
+    targetUserId: Optional[str] = None
+
+class WebRTCOffer(WebRTCSignal, tag="webrtc_offer"):
+    pass
+
+class WebRTCAnswer(WebRTCSignal, tag="webrtc_answer"):
+    pass
+
+class WebRTCIce(WebRTCSignal, tag="webrtc_ice"):
+    pass
+
+client_message_decoder = msgspec.json.Decoder(
+    Union[Join, CodeChange, LanguageChange, CursorUpdate, WebRTCOffer, WebRTCAnswer, WebRTCIce]
+)
+
 # ============ In-Memory State ============
 
-class ConnectionManager:
+def coalesce_key(message: dict) -> Optional[str]:
+    """Messages with the same key supersede each other when queued together"""
+    msg_type = message.get("type")
+    if msg_type in ("code_change", "participants_update"):
+        return msg_type
+    if msg_type == "cursor_update":
+        return f"cursor_update:{message.get('userId')}"
+    return None
+
+def merge_frames(items: List[tuple]) -> str:
+    """Collapse queued (coalesce_key, frame) pairs into a single frame
+
+    Only the latest frame per coalesce key is kept; if more than one frame
+    remains they are wrapped in a ``batch`` envelope, in order.
+    """
+    latest = {key: i for i, (key, _) in enumerate(items) if key is not None}
+    frames = [frame for i, (key, frame) in enumerate(items) if key is None or latest[key] == i]
+    if len(frames) == 1:
+        return frames[0]
+    # Frames are already JSON, so the envelope is assembled without re-encoding
+    return '{"type":"batch","messages":[' + ",".join(frames) + "]}"
+
+class SessionConns:
+    """Connections of one session kept as parallel, densely packed lists"""
+    __slots__ = ("users", "sockets", "queues", "writers", "user_index")
+
     def __init__(self):
-        # session_id -> {user_id: WebSocket}
-        self.active_connections: Dict[str, Dict[str, WebSocket]] = {}
-        # session_id -> {code, language, participants}
+        self.users: List[str] = []
+        self.sockets: List[WebSocket] = []
+        # Outgoing (coalesce_key, frame) pairs per socket, drained by the
+        # matching writer task
+        self.queues: List[asyncio.Queue] = []
+        self.writers: List[asyncio.Task] = []
+        # user_id -> position in the lists above
+        self.user_index: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.user_index
+
+    def add(self, user_id: str, websocket: WebSocket, queue: asyncio.Queue, writer: asyncio.Task):
+        self.user_index[user_id] = len(self.users)
+        self.users.append(user_id)
+        self.sockets.append(websocket)
+        self.queues.append(queue)
+        self.writers.append(writer)
+
+    def remove(self, user_id: str) -> Optional[tuple]:
+        """Remove a user and return its (websocket, writer), if connected"""
+        index = self.user_index.pop(user_id, None)
+        if index is None:
+            return None
+        removed = (self.sockets[index], self.writers[index])
+        # Move the last entry into the freed slot to keep the lists dense
+        last_user = self.users.pop()
+        last_socket = self.sockets.pop()
+        last_queue = self.queues.pop()
+        last_writer = self.writers.pop()
+        if index < len(self.users):
+            self.users[index] = last_user
+            self.sockets[index] = last_socket
+            self.queues[index] = last_queue
+            self.writers[index] = last_writer
+            self.user_index[last_user] = index
+        return removed
+
+    def get_queue(self, user_id: str) -> Optional[asyncio.Queue]:
+        index = self.user_index.get(user_id)
+        return self.queues[index] if index is not None else None
+
+class ConnectionManager:
+    def __init__(self, redis_client: Optional[redis.Redis] = None):
+        # session_id -> sockets of every connected user
+        self.active_connections: Dict[str, SessionConns] = {}
+        # session_id -> {code, language}
         self.session_states: Dict[str, dict] = {}
+        # session_id -> {user_id: participant}
+        self.participants: Dict[str, Dict[str, dict]] = {}
+        # session_id -> participant list / encoded participants_update frame,
+        # rebuilt lazily after a membership change
+        self.participants_list_cache: Dict[str, List[dict]] = {}
+        self.participants_frame_cache: Dict[str, str] = {}
+        # session_id -> timer for the pending participants_update broadcast
+        self._pending_participants_flush: Dict[str, asyncio.TimerHandle] = {}
+        # session_ids with code/language changes not yet persisted
+        self.dirty_sessions: Set[str] = set()
+        self.flush_task: Optional[asyncio.Task] = None
+        # Current UTC time as a second-resolution ISO string, refreshed once a
+        # second by clock_task
+        self.now_iso: str = ""
+        self.clock_task: Optional[asyncio.Task] = None
+        # Fire-and-forget work: closing slow sockets, Redis bookkeeping
+        self.background_tasks: Set[asyncio.Task] = set()
+        # session_id -> (fetched_at, session document)
+        self.session_doc_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        # Cross-worker fan-out; None when running as a single worker
+        self.redis = redis_client
+        self.pubsub = None
+        self.pubsub_task: Optional[asyncio.Task] = None
+        self.heartbeat_task: Optional[asyncio.Task] = None
+        # Sessions whose channel this worker is subscribed to
+        self.subscribed: Set[str] = set()
+        # Serializes subscribing/loading against unsubscribing/evicting a session
+        self.session_locks: Dict[str, asyncio.Lock] = {}
+        # session_id -> user_id -> participant, for the users connected to this worker
+        self.local_participants: Dict[str, Dict[str, dict]] = {}
+        # session_id -> connects still in progress, which keep it from being released
+        self.pending_connects: Dict[str, int] = {}
+        # Tags this worker's publications so it can tell its own echoes apart
+        self.worker_id = secrets.token_hex(4)
 
     async def connect(self, websocket: WebSocket, session_id: str, user_id: str):
-        await websocket.accept()
-        if session_id not in self.active_connections:
-            self.active_connections[session_id] = {}
-        self.active_connections[session_id][user_id] = websocket
-        
-        # Initialize session state if needed
-        if session_id not in self.session_states:
-            # Try to load from database
+        self.pending_connects[session_id] = self.pending_connects.get(session_id, 0) + 1
+        try:
+            if self.redis:
+                # Join the session's cross-worker feed while the handshake completes
+                await asyncio.gather(websocket.accept(), self._join_session(session_id))
+            elif session_id in self.session_states:
+                await websocket.accept()
+            else:
+                # Load the session from the database while the handshake completes
+                await asyncio.gather(websocket.accept(), self._load_session_state(session_id))
+            if session_id not in self.active_connections:
+                self.active_connections[session_id] = SessionConns()
+            conns = self.active_connections[session_id]
+            if user_id in conns:
+                # Same user reconnected; retire the old writer
+                conns.remove(user_id)[1].cancel()
+            queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+            writer = asyncio.create_task(self._writer(websocket, queue, user_id))
+            conns.add(user_id, websocket, queue, writer)
+        finally:
+            pending = self.pending_connects[session_id] - 1
+            if pending:
+                self.pending_connects[session_id] = pending
+            else:
+                del self.pending_connects[session_id]
+                if session_id not in self.active_connections:
+                    # Handshake failed and nobody else is here
+                    self._session_emptied(session_id)
+
+    async def _load_session_state(self, session_id: str, replace: bool = False):
+        # Try to load from database
+        session = self.get_cached_session(session_id)
+        if session is None:
             session = await db.sessions.find_one({"session_id": session_id}, {"_id": 0})
             if session:
-                self.session_states[session_id] = {
-                    "code": session.get("code", ""),
-                    "language": session.get("language", "javascript"),
-                    "participants": []
-                }
-            else:
-                self.session_states[session_id] = {
-                    "code": "",
-                    "language": "javascript",
-                    "participants": []
-                }
+                self.cache_session(session_id, session)
+        # Edits not yet flushed to the database are kept in Redis
+        shared = None
+        if self.redis:
+            shared = await self._run_pipeline(
+                "load session state", lambda pipe: pipe.hgetall(STATE_KEY_PREFIX + session_id)
+            )
+        if session_id in self.session_states and not replace:
+            # Another connection to this session finished loading first
+            return
+        if session:
+            state = {
+                "code": load_code(session),
+                "language": session.get("language", "javascript")
+            }
+        else:
+            state = {
+                "code": "",
+                "language": "javascript"
+            }
+        if shared:
+            state.update((field.decode(), value.decode()) for field, value in shared[0].items())
+        self.session_states[session_id] = state
+        self.participants.setdefault(session_id, {})
 
-    def disconnect(self, session_id: str, user_id: str):
+    async def disconnect(self, session_id: str, user_id: str):
         if session_id in self.active_connections:
-            self.active_connections[session_id].pop(user_id, None)
+            removed = self.active_connections[session_id].remove(user_id)
+            if removed:
+                removed[1].cancel()
             if not self.active_connections[session_id]:
                 del self.active_connections[session_id]
+                self._session_emptied(session_id)
         
         # Remove from participants
-        if session_id in self.session_states:
-            self.session_states[session_id]["participants"] = [
-                p for p in self.session_states[session_id]["participants"]
-                if p.get("userId") != user_id
-            ]
+        participants = self.participants.get(session_id)
+        if participants is not None and participants.pop(user_id, None) is not None:
+            self._participants_changed(session_id)
+        local = self.local_participants.get(session_id)
+        if local is not None and local.pop(user_id, None) is not None:
+            if not local:
+                del self.local_participants[session_id]
+            def leave(pipe):
+                pipe.hdel(PARTICIPANTS_KEY_PREFIX + session_id, user_id)
+                self._add_publish(pipe, SESSION_CHANNEL_PREFIX + session_id, {"members": True})
+            await self._run_pipeline("remove participant", leave)
 
-    async def broadcast(self, session_id: str, message: dict, exclude_user: str = None):
-        if session_id in self.active_connections:
-            for user_id, websocket in self.active_connections[session_id].items():
+    async def broadcast(self, session_id: str, message: dict, exclude_user: str = None,
+                        state: Optional[dict] = None):
+        """Send a message to the session; `state` holds session state fields
+        it changes, applied by every worker in channel order"""
+        if self.redis is None:
+            conns = self.active_connections.get(session_id)
+            if not conns:
+                return
+            # Sender alone in the session: nobody to encode for
+            if exclude_user and len(conns) == 1 and exclude_user in conns:
+                return
+        # Encode once for every recipient
+        await self.broadcast_text(
+            session_id, orjson.dumps(message).decode(), exclude_user, coalesce_key(message), state
+        )
+
+    async def broadcast_text(self, session_id: str, payload: str, exclude_user: str = None,
+                             key: Optional[str] = None, state: Optional[dict] = None):
+        if self.redis:
+            def relay(pipe):
+                if state:
+                    # Stored next to the event so workers joining later load it
+                    pipe.hset(STATE_KEY_PREFIX + session_id, mapping=state)
+                    pipe.expire(STATE_KEY_PREFIX + session_id, SESSION_STATE_TTL)
+                self._add_publish(pipe, SESSION_CHANNEL_PREFIX + session_id, {
+                    "payload": payload,
+                    "exclude": exclude_user,
+                    "key": key,
+                    "state": state
+                })
+            relayed = await self._run_pipeline("relay broadcast", relay)
+            if relayed is not None and session_id in self.subscribed:
+                # Local sockets get it from the subscription too, so every
+                # worker delivers the session's messages in the same order
+                return
+        self._enqueue(session_id, payload, exclude_user, key)
+
+    def _enqueue(self, session_id: str, payload: str, exclude_user: Optional[str], key: Optional[str]):
+        conns = self.active_connections.get(session_id)
+        if conns:
+            # Only enqueue here; each socket's writer task does the actual send,
+            # so one slow socket doesn't hold up the rest
+            slow = []
+            users = conns.users
+            for i, queue in enumerate(conns.queues):
+                user_id = users[i]
                 if exclude_user and user_id == exclude_user:
                     continue
                 try:
-                    await websocket.send_json(message)
-                except Exception as e:
-                    logger.error(f"Error broadcasting to {user_id}: {e}")
+                    queue.put_nowait((key, payload))
+                except asyncio.QueueFull:
+                    slow.append(user_id)
+            for user_id in slow:
+                self._drop_slow_client(session_id, user_id)
 
     async def send_to_user(self, session_id: str, user_id: str, message: dict):
-        if session_id in self.active_connections:
-            websocket = self.active_connections[session_id].get(user_id)
-            if websocket:
+        if self.redis or session_id in self.active_connections:
+            await self.send_text_to_user(
+                session_id, user_id, orjson.dumps(message).decode(), coalesce_key(message)
+            )
+
+    async def send_text_to_user(self, session_id: str, user_id: str, payload: str,
+                                key: Optional[str] = None):
+        if self.redis:
+            # Delivered by whichever worker holds the user's socket, in channel order
+            relayed = await self._run_pipeline("relay to user", lambda pipe: self._add_publish(
+                pipe, SESSION_CHANNEL_PREFIX + session_id, {
+                    "payload": payload,
+                    "key": key,
+                    "target": user_id
+                }
+            ))
+            if relayed is not None and session_id in self.subscribed:
+                return
+        self._enqueue_to_user(session_id, user_id, payload, key)
+
+    def _enqueue_to_user(self, session_id: str, user_id: str, payload: str,
+                         key: Optional[str]) -> bool:
+        """Queue a frame for a locally connected user; False if not connected here"""
+        conns = self.active_connections.get(session_id)
+        queue = conns.get_queue(user_id) if conns else None
+        if queue is None:
+            return False
+        try:
+            queue.put_nowait((key, payload))
+        except asyncio.QueueFull:
+            self._drop_slow_client(session_id, user_id)
+        return True
+
+    async def _writer(self, websocket: WebSocket, queue: asyncio.Queue, user_id: str):
+        while True:
+            items = [await queue.get()]
+            # Whatever piled up while the last send was in flight goes out as one frame
+            while True:
                 try:
-                    await websocket.send_json(message)
-                except Exception as e:
-                    logger.error(f"Error sending to {user_id}: {e}")
+                    items.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            payload = items[0][1] if len(items) == 1 else merge_frames(items)
+            try:
+                await websocket.send_text(payload)
+            except Exception as e:
+                logger.error("Error sending to %s: %s", user_id, e)
+                return
+
+    def _drop_slow_client(self, session_id: str, user_id: str):
+        logger.warning("Dropping slow client %s from session %s", user_id, session_id)
+        conns = self.active_connections[session_id]
+        websocket, writer = conns.remove(user_id)
+        writer.cancel()
+        if not conns:
+            del self.active_connections[session_id]
+            self._session_emptied(session_id)
+        # The client's receive loop sees the close and runs the usual cleanup
+        self._spawn(self._close(websocket))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            pass
 
     def get_participants(self, session_id: str) -> List[dict]:
-        if session_id in self.session_states:
-            return self.session_states[session_id].get("participants", [])
-        return []
+        cached = self.participants_list_cache.get(session_id)
+        if cached is None:
+            participants = self.participants.get(session_id)
+            if participants is None:
+                return []
+            cached = self.participants_list_cache[session_id] = list(participants.values())
+        return cached
 
-    def add_participant(self, session_id: str, user_id: str, username: str):
-        if session_id in self.session_states:
-            # Check if already exists
-            existing = [p for p in self.session_states[session_id]["participants"] if p.get("userId") == user_id]
-            if not existing:
-                self.session_states[session_id]["participants"].append({
-                    "userId": user_id,
-                    "username": username,
-                    "joinedAt": datetime.now(timezone.utc).isoformat()
-                })
+    def get_participants_frame(self, session_id: str) -> str:
+        """Encoded participants_update message, reused until membership changes"""
+        frame = self.participants_frame_cache.get(session_id)
+        if frame is None:
+            frame = self.participants_frame_cache[session_id] = orjson.dumps({
+                "type": "participants_update",
+                "participants": self.get_participants(session_id)
+            }).decode()
+        return frame
+
+    def _participants_changed(self, session_id: str):
+        self.participants_list_cache.pop(session_id, None)
+        self.participants_frame_cache.pop(session_id, None)
+        # Debounce the participants_update broadcast so a burst of joins/leaves
+        # goes out as a single frame
+        if session_id not in self._pending_participants_flush:
+            self._pending_participants_flush[session_id] = asyncio.get_running_loop().call_later(
+                PARTICIPANTS_UPDATE_DELAY, self._emit_participants_update, session_id
+            )
+
+    def _emit_participants_update(self, session_id: str):
+        self._pending_participants_flush.pop(session_id, None)
+        if session_id in self.active_connections:
+            self._enqueue(session_id, self.get_participants_frame(session_id), None, "participants_update")
+
+    async def add_participant(self, session_id: str, user_id: str, username: str):
+        participants = self.participants.get(session_id)
+        if participants is None:
+            return
+        # With Redis, participants also holds users connected to other workers
+        local = self.local_participants.setdefault(session_id, {}) if self.redis else participants
+        if user_id in local:
+            return
+        participant = participants.get(user_id)
+        if participant is None:
+            participant = participants[user_id] = {
+                "userId": user_id,
+                "username": username,
+                "joinedAt": self.now_iso or datetime.now(timezone.utc).isoformat(timespec="seconds")
+            }
+            self._participants_changed(session_id)
+        local[user_id] = participant
+        if self.redis:
+            def join(pipe):
+                self._add_participants(pipe, session_id, [participant])
+                self._add_publish(pipe, SESSION_CHANNEL_PREFIX + session_id, {"members": True})
+            await self._run_pipeline("add participant", join)
+
+    def _add_participants(self, pipe, session_id: str, participants: List[dict]):
+        """Queue writing participants to the shared hash, stamped with the time
+        so entries a dead worker stops refreshing can be told apart"""
+        seen = time.time()
+        key = PARTICIPANTS_KEY_PREFIX + session_id
+        pipe.hset(key, mapping={
+            p["userId"]: orjson.dumps({"seen": seen, "participant": p}) for p in participants
+        })
+        pipe.expire(key, PARTICIPANT_TTL)
+
+    async def _load_participants(self, session_id: str):
+        """Replace this worker's participant list with the one shared in Redis,
+        keeping its own users even if writing them there failed"""
+        key = PARTICIPANTS_KEY_PREFIX + session_id
+        result = await self._run_pipeline("load participants", lambda pipe: pipe.hgetall(key))
+        if result is None or session_id not in self.session_states:
+            return
+        cutoff = time.time() - PARTICIPANT_TTL
+        loaded = {}
+        stale = []
+        for user_id, entry in result[0].items():
+            entry = orjson.loads(entry)
+            if entry["seen"] < cutoff:
+                stale.append(user_id)
+            else:
+                loaded[user_id.decode()] = entry["participant"]
+        if stale:
+            await self._run_pipeline("drop stale participants", lambda pipe: pipe.hdel(key, *stale))
+        loaded.update(self.local_participants.get(session_id, {}))
+        changed = loaded.keys() != self.participants.get(session_id, {}).keys()
+        self.participants[session_id] = loaded
+        if changed:
+            self._participants_changed(session_id)
+
+    def get_cached_session(self, session_id: str) -> Optional[dict]:
+        entry = self.session_doc_cache.get(session_id)
+        if entry is None:
+            return None
+        fetched_at, session = entry
+        if time.monotonic() - fetched_at > SESSION_CACHE_TTL:
+            del self.session_doc_cache[session_id]
+            return None
+        self.session_doc_cache.move_to_end(session_id)
+        return session
+
+    def cache_session(self, session_id: str, session: dict):
+        self.session_doc_cache[session_id] = (time.monotonic(), session)
+        self.session_doc_cache.move_to_end(session_id)
+        while len(self.session_doc_cache) > SESSION_CACHE_SIZE:
+            self.session_doc_cache.popitem(last=False)
 
     def update_code(self, session_id: str, code: str):
         if session_id in self.session_states:
             self.session_states[session_id]["code"] = code
+            self.dirty_sessions.add(session_id)
 
     def update_language(self, session_id: str, language: str):
         if session_id in self.session_states:
             self.session_states[session_id]["language"] = language
+            self.dirty_sessions.add(session_id)
+
+    async def flush(self):
+        """Persist code/language of all dirty sessions in a single bulk write"""
+        if not self.dirty_sessions:
+            return
+        dirty, self.dirty_sessions = self.dirty_sessions, set()
+        ops = []
+        for session_id in dirty:
+            state = self.session_states.get(session_id)
+            if state is None:
+                continue
+            ops.append(UpdateOne(
+                {"session_id": session_id},
+                {
+                    "$set": {"code_z": compress_code(state["code"]), "language": state["language"]},
+                    "$unset": {"code": ""}
+                },
+                upsert=True
+            ))
+        if not ops:
+            return
+        try:
+            await db.sessions.bulk_write(ops, ordered=False)
+        except Exception as e:
+            logger.error("Error flushing sessions: %s", e)
+            # Retry on the next tick
+            self.dirty_sessions |= dirty
+            return
+        # Cached documents for these sessions are now stale, here and on other workers
+        for session_id in dirty:
+            self.session_doc_cache.pop(session_id, None)
+        if self.redis:
+            await self._run_pipeline(
+                "announce flush",
+                lambda pipe: self._add_publish(pipe, FLUSHED_CHANNEL, {"sessions": list(dirty)})
+            )
+
+    # ---- Cross-worker pub/sub ----
+
+    async def _run_pipeline(self, action: str, build) -> Optional[list]:
+        """Run the commands `build` queues on a pipeline in one round-trip
+
+        Redis carries only live events, so failures are logged and the result
+        is None rather than breaking the caller.
+        """
+        try:
+            # MULTI/EXEC keeps a state write and its publish adjacent, so the
+            # stored state matches the last message on the channel
+            pipe = self.redis.pipeline(transaction=True)
+            build(pipe)
+            return await pipe.execute()
+        except Exception as e:
+            logger.error("Redis error (%s): %s", action, e)
+            return None
+
+    def _add_publish(self, pipe, channel: str, envelope: dict):
+        envelope["worker"] = self.worker_id
+        pipe.publish(channel, orjson.dumps(envelope))
+
+    def _session_lock(self, session_id: str) -> asyncio.Lock:
+        lock = self.session_locks.get(session_id)
+        if lock is None:
+            lock = self.session_locks[session_id] = asyncio.Lock()
+        return lock
+
+    def _session_in_use(self, session_id: str) -> bool:
+        return session_id in self.active_connections or session_id in self.pending_connects
+
+    async def _join_session(self, session_id: str):
+        async with self._session_lock(session_id):
+            if session_id in self.subscribed or not self._session_in_use(session_id):
+                # Already joined, or the connection gave up while waiting
+                return
+            # Subscribe before loading so no update published after the load is missed
+            try:
+                await self.pubsub.subscribe(SESSION_CHANNEL_PREFIX + session_id)
+                self.subscribed.add(session_id)
+            except Exception as e:
+                logger.error("Error subscribing to session %s: %s", session_id, e)
+            # Whatever this worker held may have missed updates while unsubscribed
+            await self._load_session_state(session_id, replace=True)
+            await self._load_participants(session_id)
+
+    def _session_emptied(self, session_id: str):
+        if self.redis:
+            self._spawn(self._release_session(session_id))
+
+    async def _release_session(self, session_id: str):
+        lock = self._session_lock(session_id)
+        async with lock:
+            if self._session_in_use(session_id):
+                return
+            if session_id in self.subscribed:
+                self.subscribed.discard(session_id)
+                try:
+                    await self.pubsub.unsubscribe(SESSION_CHANNEL_PREFIX + session_id)
+                except Exception as e:
+                    logger.error("Error unsubscribing from session %s: %s", session_id, e)
+            if session_id in self.dirty_sessions:
+                await self.flush()
+            if self._session_in_use(session_id) or session_id in self.dirty_sessions:
+                # A new connection resubscribes and reloads once it gets the lock
+                return
+            # Unsubscribed, this worker's copy of the session would go stale
+            self.session_states.pop(session_id, None)
+            self.participants.pop(session_id, None)
+            self.local_participants.pop(session_id, None)
+            self.participants_list_cache.pop(session_id, None)
+            self.participants_frame_cache.pop(session_id, None)
+            timer = self._pending_participants_flush.pop(session_id, None)
+            if timer:
+                timer.cancel()
+            if self.session_locks.get(session_id) is lock:
+                # An earlier release may already have dropped it
+                del self.session_locks[session_id]
+
+    async def _pubsub_loop(self):
+        while True:
+            try:
+                async for item in self.pubsub.listen():
+                    if item["type"] != "message":
+                        continue
+                    try:
+                        self._on_pubsub_message(item["channel"].decode(), orjson.loads(item["data"]))
+                    except Exception as e:
+                        logger.error("Error handling pub/sub message: %s", e)
+                logger.error("Pub/sub listener stopped; restarting")
+            except Exception as e:
+                # The pub/sub client reconnects and resubscribes on the next listen
+                logger.error("Pub/sub connection failed, retrying: %s", e)
+            await asyncio.sleep(PUBSUB_RETRY_DELAY)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(PARTICIPANT_HEARTBEAT)
+            # Keep this worker's participants from expiring in Redis
+            def refresh(pipe):
+                for session_id, local in self.local_participants.items():
+                    self._add_participants(pipe, session_id, list(local.values()))
+            await self._run_pipeline("refresh participants", refresh)
+            # and drop the ones dead workers stopped refreshing
+            for session_id in list(self.subscribed):
+                await self._load_participants(session_id)
+
+    def _on_pubsub_message(self, channel: str, envelope: dict):
+        own = envelope["worker"] == self.worker_id
+        if channel == FLUSHED_CHANNEL:
+            if not own:
+                for session_id in envelope["sessions"]:
+                    self.session_doc_cache.pop(session_id, None)
+            return
+        session_id = channel[len(SESSION_CHANNEL_PREFIX):]
+        state = envelope.get("state")
+        if state and session_id in self.session_states:
+            # Every worker, the sender included, applies changes in channel
+            # order and persists the result, so the last write is the final state
+            self.session_states[session_id].update(state)
+            self.dirty_sessions.add(session_id)
+        if envelope.get("members") and not own:
+            self._spawn(self._load_participants(session_id))
+        payload = envelope.get("payload")
+        if payload is not None:
+            target = envelope.get("target")
+            if target:
+                self._enqueue_to_user(session_id, target, payload, envelope["key"])
+            else:
+                self._enqueue(session_id, payload, envelope["exclude"], envelope["key"])
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self.flush()
+
+    async def _clock_loop(self):
+        while True:
+            self.now_iso = datetime.now(timezone.utc).isoformat(timespec="seconds")
+            await asyncio.sleep(1)
+
+    async def start_background_tasks(self):
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_loop())
+        if self.clock_task is None:
+            self.clock_task = asyncio.create_task(self._clock_loop())
+        if self.redis and self.pubsub_task is None:
+            self.pubsub = self.redis.pubsub()
+            await self.pubsub.subscribe(FLUSHED_CHANNEL)
+            self.pubsub_task = asyncio.create_task(self._pubsub_loop())
+            self.heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop_background_tasks(self):
+        for task in (self.flush_task, self.clock_task, self.pubsub_task, self.heartbeat_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.flush_task = None
+        self.clock_task = None
+        self.pubsub_task = None
+        self.heartbeat_task = None
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+            self.pubsub = None
+        for timer in self._pending_participants_flush.values():
+            timer.cancel()
+        self._pending_participants_flush.clear()
+        self.now_iso = ""
+        await self.flush()
 
     def get_session_state(self, session_id: str) -> dict:
         return self.session_states.get(session_id, {})
 
-manager = ConnectionManager()
+manager = ConnectionManager(redis_client)
 
 # ============ REST Endpoints ============
 
@@ -148,13 +799,16 @@ manager = ConnectionManager()
 async def root():
     return {"message": "CodeSphere API"}
 
-@api_router.post("/sessions", response_model=SessionResponse)
+# Session endpoints return ORJSONResponse directly, skipping response model
+# validation; SessionResponse only documents the schema
+@api_router.post("/sessions", responses={200: {"model": SessionResponse}})
 async def create_session(data: SessionCreate = None):
     """Create a new collaboration session"""
     if data is None:
         data = SessionCreate()
     
-    session_id = str(uuid.uuid4())[:8]
+    # 6 random bytes encode to exactly 8 URL-safe characters
+    session_id = secrets.token_urlsafe(6)
     now = datetime.now(timezone.utc)
     
     session_doc = {
@@ -165,136 +819,143 @@ async def create_session(data: SessionCreate = None):
         "participants": []
     }
     
-    await db.sessions.insert_one(session_doc)
+    # insert_one adds the ObjectId to the dict it is given
+    await db.sessions.insert_one(dict(session_doc))
     
-    return SessionResponse(
-        session_id=session_id,
-        code="",
-        language=data.language,
-        created_at=now.isoformat(),
-        participants=[]
-    )
-
-@api_router.get("/sessions/{session_id}", response_model=SessionResponse)
+    return ORJSONResponse(session_doc)
+
+@api_router.get("/sessions/{session_id}", responses={200: {"model": SessionResponse}})
 async def get_session(session_id: str):
     """Get session details"""
-    session = await db.sessions.find_one({"session_id": session_id}, {"_id": 0})
-    if not session:
-        # Create if doesn't exist
+    session = manager.get_cached_session(session_id)
+    if session is None:
+        # Create if doesn't exist, atomically and in a single round-trip
         now = datetime.now(timezone.utc)
-        session = {
+        defaults = {
             "session_id": session_id,
             "code": "",
             "language": "javascript",
             "created_at": now.isoformat(),
             "participants": []
         }
-        await db.sessions.insert_one(session)
+        session = await db.sessions.find_one_and_update(
+            {"session_id": session_id},
+            {"$setOnInsert": defaults},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+            projection={"_id": 0}
+        )
+        manager.cache_session(session_id, session)
     
-    return SessionResponse(
-        session_id=session["session_id"],
-        code=session.get("code", ""),
-        language=session.get("language", "javascript"),
-        created_at=session.get("created_at", datetime.now(timezone.utc).isoformat()),
-        participants=session.get("participants", [])
-    )
+    return ORJSONResponse({
+        "session_id": session["session_id"],
+        "code": load_code(session),
+        "language": session.get("language", "javascript"),
+        "created_at": session.get("created_at", datetime.now(timezone.utc).isoformat()),
+        "participants": session.get("participants", [])
+    })
 
 # ============ WebSocket Endpoint ============
 
+# Payload of a received WebSocket frame, text or binary
+Frame = Union[str, bytes]
+
+async def handle_join(message: Join, session_id: str, user_id: str, raw: Frame):
+    username = message.username or f"User_{user_id[:4]}"
+    # Also schedules the debounced participants_update to all
+    await manager.add_participant(session_id, user_id, username)
+    
+    # Send current session state to the new user
+    state = manager.get_session_state(session_id)
+    await manager.send_to_user(session_id, user_id, {
+        "type": "session_state",
+        "code": state.get("code", ""),
+        "language": state.get("language", "javascript"),
+        "participants": manager.get_participants(session_id)
+    })
+    
+    # Notify others
+    await manager.broadcast(session_id, {
+        "type": "user_joined",
+        "userId": user_id,
+        "username": username,
+        "participants": manager.get_participants(session_id)
+    }, exclude_user=user_id)
+
+async def handle_code_change(message: CodeChange, session_id: str, user_id: str, raw: Frame):
+    # Persisted by the manager's periodic flush
+    manager.update_code(session_id, message.code)
+    
+    # Broadcast to others
+    await manager.broadcast(session_id, {
+        "type": "code_change",
+        "code": message.code,
+        "userId": user_id
+    }, exclude_user=user_id, state={"code": message.code})
+
+async def handle_language_change(message: LanguageChange, session_id: str, user_id: str, raw: Frame):
+    manager.update_language(session_id, message.language)
+    
+    await manager.broadcast(session_id, {
+        "type": "language_change",
+        "language": message.language,
+        "userId": user_id
+    }, exclude_user=user_id, state={"language": message.language})
+
+async def handle_cursor_update(message: CursorUpdate, session_id: str, user_id: str, raw: Frame):
+    await manager.broadcast(session_id, {
+        "type": "cursor_update",
+        "userId": user_id,
+        "position": message.position,
+        "username": message.username
+    }, exclude_user=user_id)
+
+async def handle_webrtc_signal(message: WebRTCSignal, session_id: str, user_id: str, raw: Frame):
+    # Relay WebRTC signaling messages unchanged to the addressed peer only;
+    # clients that don't name one fall back to the whole session
+    payload = raw if isinstance(raw, str) else raw.decode()
+    if message.targetUserId:
+        await manager.send_text_to_user(session_id, message.targetUserId, payload)
+    else:
+        await manager.broadcast_text(session_id, payload, exclude_user=user_id)
+
+MESSAGE_HANDLERS = {
+    Join: handle_join,
+    CodeChange: handle_code_change,
+    LanguageChange: handle_language_change,
+    CursorUpdate: handle_cursor_update,
+    WebRTCOffer: handle_webrtc_signal,
+    WebRTCAnswer: handle_webrtc_signal,
+    WebRTCIce: handle_webrtc_signal,
+}
+
 @api_router.websocket("/ws/{session_id}/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, session_id: str, user_id: str):
     await manager.connect(websocket, session_id, user_id)
-    logger.info(f"User {user_id} connected to session {session_id}")
+    logger.debug("User %s connected to session %s", user_id, session_id)
     
     try:
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
-            msg_type = message.get("type")
-            
-            if msg_type == "join":
-                username = message.get("username", f"User_{user_id[:4]}")
-                manager.add_participant(session_id, user_id, username)
-                
-                # Send current session state to the new user
-                state = manager.get_session_state(session_id)
-                await manager.send_to_user(session_id, user_id, {
-                    "type": "session_state",
-                    "code": state.get("code", ""),
-                    "language": state.get("language", "javascript"),
-                    "participants": state.get("participants", [])
-                })
-                
-                # Notify others
-                await manager.broadcast(session_id, {
-                    "type": "user_joined",
-                    "userId": user_id,
-                    "username": username,
-                    "participants": manager.get_participants(session_id)
-                }, exclude_user=user_id)
-                
-                # Send updated participants to all
-                await manager.broadcast(session_id, {
-                    "type": "participants_update",
-                    "participants": manager.get_participants(session_id)
-                })
-            
-            elif msg_type == "code_change":
-                code = message.get("code", "")
-                manager.update_code(session_id, code)
-                
-                # Save to database periodically (debounced in real app)
-                await db.sessions.update_one(
-                    {"session_id": session_id},
-                    {"$set": {"code": code}},
-                    upsert=True
-                )
-                
-                # Broadcast to others
-                await manager.broadcast(session_id, {
-                    "type": "code_change",
-                    "code": code,
-                    "userId": user_id
-                }, exclude_user=user_id)
-            
-            elif msg_type == "language_change":
-                language = message.get("language", "javascript")
-                manager.update_language(session_id, language)
-                
-                await db.sessions.update_one(
-                    {"session_id": session_id},
-                    {"$set": {"language": language}},
-                    upsert=True
-                )
-                
-                await manager.broadcast(session_id, {
-                    "type": "language_change",
-                    "language": language,
-                    "userId": user_id
-                }, exclude_user=user_id)
-            
-            elif msg_type == "cursor_update":
-                await manager.broadcast(session_id, {
-                    "type": "cursor_update",
-                    "userId": user_id,
-                    "position": message.get("position"),
-                    "username": message.get("username")
-                }, exclude_user=user_id)
-            
-            elif msg_type in ["webrtc_offer", "webrtc_answer", "webrtc_ice"]:
-                # Relay WebRTC signaling messages
-                await manager.broadcast(session_id, message, exclude_user=user_id)
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            # Binary frames are parsed as-is, text frames without re-encoding
+            raw = frame.get("bytes")
+            if raw is None:
+                raw = frame.get("text")
+            try:
+                message = client_message_decoder.decode(raw)
+            except msgspec.ValidationError as e:
+                # Unknown message type or mistyped fields; ignore the message
+                logger.debug("Ignoring message from user %s: %s", user_id, e)
+                continue
+            await MESSAGE_HANDLERS[type(message)](message, session_id, user_id, raw)
     
     except WebSocketDisconnect:
-        logger.info(f"User {user_id} disconnected from session {session_id}")
-        username = None
-        participants = manager.get_participants(session_id)
-        for p in participants:
-            if p.get("userId") == user_id:
-                username = p.get("username")
-                break
+        logger.debug("User %s disconnected from session %s", user_id, session_id)
+        username = manager.participants.get(session_id, {}).get(user_id, {}).get("username")
         
-        manager.disconnect(session_id, user_id)
+        await manager.disconnect(session_id, user_id)
         
         # Notify others
         await manager.broadcast(session_id, {
@@ -304,8 +965,8 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str, user_id: str
             "participants": manager.get_participants(session_id)
         })
     except Exception as e:
-        logger.error(f"WebSocket error for user {user_id}: {e}")
-        manager.disconnect(session_id, user_id)
+        logger.error("WebSocket error for user %s: %s", user_id, e)
+        await manager.disconnect(session_id, user_id)
 
 # Include the router
 app.include_router(api_router)
@@ -318,6 +979,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def ensure_indexes():
+    try:
+        await db.sessions.create_index("session_id", unique=True)
+    except Exception as e:
+        # Usually duplicate session_ids left by the old find-then-insert in
+        # get_session; lookups still work, just without the index
+        logger.error("Could not create unique index on sessions.session_id: %s", e)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    await manager.start_background_tasks()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await manager.stop_background_tasks()
     client.close()
+    if redis_client is not None:
+        await redis_client.aclose()
@@ -6,6 +6,7 @@ Tests all REST endpoints and WebSocket functionality
 
 import requests
 import json
+import re
 import sys
 import time
 from datetime import datetime
@@ -65,8 +66,8 @@ class CodeSphereAPITester:
                 data = response.json()
                 self.session_id = data.get("session_id")
                 
-                # Verify session_id format (8 characters)
-                if self.session_id and len(self.session_id) == 8:
+                # Verify session_id format (8 URL-safe characters)
+                if self.session_id and re.fullmatch(r"[A-Za-z0-9_-]{8}", self.session_id):
                     self.log(f"Created session: {self.session_id}")
                     return True
                 else:
@@ -138,8 +139,10 @@ class CodeSphereAPITester:
         """WebSocket message handler"""
         try:
             data = json.loads(message)
-            self.ws_messages.append(data)
-            self.log(f"WS Message: {data.get('type', 'unknown')}")
+            # Messages queued together arrive wrapped in a batch envelope
+            for item in data["messages"] if data.get("type") == "batch" else [data]:
+                self.ws_messages.append(item)
+                self.log(f"WS Message: {item.get('type', 'unknown')}")
         except Exception as e:
             self.log(f"WS message parse error: {e}")
 
@@ -0,0 +1,68 @@
+"""
+Tests for how queued WebSocket frames are coalesced into one send
+"""
+
+import sys
+from pathlib import Path
+
+import orjson
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+from server import coalesce_key, merge_frames  # noqa: E402
+
+
+def queued(*messages):
+    return [(coalesce_key(message), orjson.dumps(message).decode()) for message in messages]
+
+
+def unwrap(frame):
+    message = orjson.loads(frame)
+    return message["messages"] if message["type"] == "batch" else [message]
+
+
+def test_single_frame_is_sent_without_batch_envelope():
+    frame = orjson.dumps({"type": "code_change", "code": "a", "userId": "u1"}).decode()
+    assert merge_frames([("code_change", frame)]) == frame
+
+
+def test_last_code_change_wins():
+    merged = merge_frames(queued(
+        {"type": "code_change", "code": "a", "userId": "u1"},
+        {"type": "code_change", "code": "ab", "userId": "u2"},
+        {"type": "code_change", "code": "abc", "userId": "u1"},
+    ))
+    assert unwrap(merged) == [{"type": "code_change", "code": "abc", "userId": "u1"}]
+    assert orjson.loads(merged)["type"] == "code_change"
+
+
+def test_cursor_updates_are_kept_per_user():
+    merged = unwrap(merge_frames(queued(
+        {"type": "cursor_update", "userId": "u1", "position": 1},
+        {"type": "cursor_update", "userId": "u2", "position": 5},
+        {"type": "cursor_update", "userId": "u1", "position": 2},
+    )))
+    assert merged == [
+        {"type": "cursor_update", "userId": "u2", "position": 5},
+        {"type": "cursor_update", "userId": "u1", "position": 2},
+    ]
+
+
+def test_uncoalesced_frames_keep_their_order():
+    messages = [
+        {"type": "session_state", "code": "", "language": "python", "participants": []},
+        {"type": "webrtc_offer", "targetUserId": "u2"},
+        {"type": "code_change", "code": "x", "userId": "u1"},
+        {"type": "webrtc_ice", "targetUserId": "u2"},
+        {"type": "user_joined", "userId": "u3", "username": "C", "participants": []},
+    ]
+    assert unwrap(merge_frames(queued(*messages))) == messages
+
+
+def test_superseded_frame_is_dropped_in_place():
+    merged = unwrap(merge_frames(queued(
+        {"type": "code_change", "code": "a", "userId": "u1"},
+        {"type": "language_change", "language": "go", "userId": "u1"},
+        {"type": "code_change", "code": "b", "userId": "u1"},
+    )))
+    assert [message["type"] for message in merged] == ["language_change", "code_change"]
+    assert merged[1]["code"] == "b"
@@ -0,0 +1,288 @@
+"""
+Cross-worker relay tests for the backend ConnectionManager
+
+Two managers sharing one in-memory Redis stand in for two Uvicorn workers;
+MongoDB is replaced by a collection that holds nothing.
+"""
+
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import fakeredis
+import orjson
+import pytest
+import redis.asyncio as redis
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+import server  # noqa: E402
+
+
+class EmptySessions:
+    async def find_one(self, *args, **kwargs):
+        return None
+
+    async def bulk_write(self, *args, **kwargs):
+        pass
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.sent.append(orjson.loads(text))
+
+    async def close(self, code=1000):
+        pass
+
+    def types(self):
+        received = []
+        for message in self.sent:
+            received.extend(message["messages"] if message["type"] == "batch" else [message])
+        return [message["type"] for message in received]
+
+
+@pytest.fixture(autouse=True)
+def empty_db(monkeypatch):
+    monkeypatch.setattr(server, "db", type("DB", (), {"sessions": EmptySessions()})())
+
+
+async def start_workers(redis_server, count=2):
+    workers = [server.ConnectionManager(fakeredis.FakeAsyncRedis(server=redis_server)) for _ in range(count)]
+    for worker in workers:
+        await worker.start_background_tasks()
+    return workers
+
+
+async def stop_workers(workers):
+    for worker in workers:
+        await worker.stop_background_tasks()
+
+
+def test_late_joiner_loads_unflushed_code():
+    async def run():
+        alice_worker, bob_worker = await start_workers(fakeredis.FakeServer())
+        await alice_worker.connect(FakeWebSocket(), "s1", "alice")
+        alice_worker.update_code("s1", "v1")
+        await alice_worker.broadcast("s1", {"type": "code_change", "code": "v1", "userId": "alice"},
+                                     exclude_user="alice", state={"code": "v1"})
+
+        await bob_worker.connect(FakeWebSocket(), "s1", "bob")
+        assert bob_worker.get_session_state("s1")["code"] == "v1"
+        await stop_workers([alice_worker, bob_worker])
+
+    asyncio.run(run())
+
+
+def test_events_reach_sockets_on_other_workers():
+    async def run():
+        alice_worker, bob_worker = await start_workers(fakeredis.FakeServer())
+        alice, bob = FakeWebSocket(), FakeWebSocket()
+        await alice_worker.connect(alice, "s1", "alice")
+        await bob_worker.connect(bob, "s1", "bob")
+        await alice_worker.add_participant("s1", "alice", "Alice")
+        await bob_worker.add_participant("s1", "bob", "Bob")
+
+        await alice_worker.broadcast("s1", {"type": "language_change", "language": "go", "userId": "alice"},
+                                     exclude_user="alice", state={"language": "go"})
+        await alice_worker.send_text_to_user("s1", "bob", '{"type":"webrtc_offer"}')
+        await asyncio.sleep(0.2)
+
+        assert "language_change" in bob.types()
+        assert "webrtc_offer" in bob.types()
+        assert bob_worker.get_session_state("s1")["language"] == "go"
+        assert set(alice_worker.participants["s1"]) == {"alice", "bob"}
+        await stop_workers([alice_worker, bob_worker])
+
+    asyncio.run(run())
+
+
+def test_concurrent_edits_converge():
+    async def run():
+        alice_worker, bob_worker = await start_workers(fakeredis.FakeServer())
+        carol, dave = FakeWebSocket(), FakeWebSocket()
+        await alice_worker.connect(FakeWebSocket(), "s1", "alice")
+        await alice_worker.connect(carol, "s1", "carol")
+        await bob_worker.connect(FakeWebSocket(), "s1", "bob")
+        await bob_worker.connect(dave, "s1", "dave")
+
+        async def edit(worker, user_id, code):
+            worker.update_code("s1", code)
+            await worker.broadcast("s1", {"type": "code_change", "code": code, "userId": user_id},
+                                   exclude_user=user_id, state={"code": code})
+
+        await asyncio.gather(*(edit(worker, user_id, f"{user_id} {n}")
+                               for n in range(5)
+                               for worker, user_id in ((alice_worker, "alice"), (bob_worker, "bob"))))
+        await asyncio.sleep(0.2)
+
+        def last_code(websocket):
+            received = []
+            for message in websocket.sent:
+                received.extend(message["messages"] if message["type"] == "batch" else [message])
+            return [message["code"] for message in received if message["type"] == "code_change"][-1]
+
+        final = alice_worker.get_session_state("s1")["code"]
+        assert bob_worker.get_session_state("s1")["code"] == final
+        assert last_code(carol) == final
+        assert last_code(dave) == final
+        await stop_workers([alice_worker, bob_worker])
+
+    asyncio.run(run())
+
+
+def test_disconnect_survives_redis_outage():
+    async def run():
+        redis_server = fakeredis.FakeServer()
+        (worker,) = await start_workers(redis_server, count=1)
+        await worker.connect(FakeWebSocket(), "s1", "alice")
+        await worker.add_participant("s1", "alice", "Alice")
+
+        redis_server.connected = False
+        await worker.disconnect("s1", "alice")
+        assert "alice" not in worker.participants.get("s1", {})
+        redis_server.connected = True
+        await stop_workers([worker])
+
+    asyncio.run(run())
+
+
+def test_participant_survives_failed_join_write(monkeypatch):
+    monkeypatch.setattr(server, "PARTICIPANT_HEARTBEAT", 0.05)
+
+    async def run():
+        redis_server = fakeredis.FakeServer()
+        alice_worker, bob_worker = await start_workers(redis_server)
+        await alice_worker.connect(FakeWebSocket(), "s1", "alice")
+        await bob_worker.connect(FakeWebSocket(), "s1", "bob")
+
+        redis_server.connected = False
+        await alice_worker.add_participant("s1", "alice", "Alice")
+        redis_server.connected = True
+        await bob_worker.add_participant("s1", "bob", "Bob")
+        await asyncio.sleep(0.3)
+
+        assert set(alice_worker.participants["s1"]) == {"alice", "bob"}
+        assert set(bob_worker.participants["s1"]) == {"alice", "bob"}
+        await stop_workers([alice_worker, bob_worker])
+
+    asyncio.run(run())
+
+
+def test_participants_of_dead_workers_expire():
+    async def run():
+        redis_server = fakeredis.FakeServer()
+        (worker,) = await start_workers(redis_server, count=1)
+        shared = fakeredis.FakeAsyncRedis(server=redis_server)
+        ghost = {"userId": "ghost", "username": "Ghost", "joinedAt": ""}
+        await shared.hset(server.PARTICIPANTS_KEY_PREFIX + "s1", "ghost", orjson.dumps({
+            "seen": time.time() - server.PARTICIPANT_TTL - 1,
+            "participant": ghost
+        }))
+
+        await worker.connect(FakeWebSocket(), "s1", "alice")
+        assert "ghost" not in worker.participants["s1"]
+        assert not await shared.hexists(server.PARTICIPANTS_KEY_PREFIX + "s1", "ghost")
+        await worker.add_participant("s1", "alice", "Alice")
+        assert await shared.ttl(server.PARTICIPANTS_KEY_PREFIX + "s1") > 0
+        await stop_workers([worker])
+
+    asyncio.run(run())
+
+
+def test_connect_racing_release_stays_subscribed():
+    async def run():
+        worker, other_worker = await start_workers(fakeredis.FakeServer())
+        await worker.connect(FakeWebSocket(), "s1", "alice")
+        await worker.disconnect("s1", "alice")
+        # The release runs in the background; reconnect before it gets going
+        bob = FakeWebSocket()
+        await worker.connect(bob, "s1", "bob")
+        await asyncio.sleep(0.1)
+
+        assert "s1" in worker.subscribed
+        assert "s1" in worker.session_states
+        await other_worker.broadcast("s1", {"type": "cursor_update", "userId": "carol"})
+        await asyncio.sleep(0.1)
+        assert "cursor_update" in bob.types()
+        await stop_workers([worker, other_worker])
+
+    asyncio.run(run())
+
+
+def test_failed_connect_during_slow_release_leaves_session_released():
+    class FailingWebSocket(FakeWebSocket):
+        async def accept(self):
+            raise ConnectionResetError
+
+    async def run():
+        (worker,) = await start_workers(fakeredis.FakeServer(), count=1)
+        errors = []
+        spawn = worker._spawn
+
+        async def checked(coro):
+            try:
+                await coro
+            except Exception as e:
+                errors.append(e)
+
+        worker._spawn = lambda coro: spawn(checked(coro))
+        unsubscribe = worker.pubsub.unsubscribe
+
+        async def slow_unsubscribe(*args):
+            await asyncio.sleep(0.1)
+            return await unsubscribe(*args)
+
+        worker.pubsub.unsubscribe = slow_unsubscribe
+        await worker.connect(FakeWebSocket(), "s1", "alice")
+        await worker.disconnect("s1", "alice")
+        await asyncio.sleep(0)
+        # Queues behind the first release, then fails and releases again
+        with pytest.raises(ConnectionResetError):
+            await worker.connect(FailingWebSocket(), "s1", "bob")
+        await asyncio.sleep(0.3)
+
+        assert errors == []
+        assert "s1" not in worker.subscribed
+        assert "s1" not in worker.session_states
+        assert "s1" not in worker.session_locks
+        await stop_workers([worker])
+
+    asyncio.run(run())
+
+
+def test_pubsub_listener_recovers_from_errors(monkeypatch):
+    listen = redis.client.PubSub.listen
+    failures = [redis.ConnectionError("connection reset")]
+
+    def flaky_listen(self):
+        if failures:
+            error = failures.pop()
+
+            async def broken():
+                raise error
+                yield
+
+            return broken()
+        return listen(self)
+
+    monkeypatch.setattr(redis.client.PubSub, "listen", flaky_listen)
+    monkeypatch.setattr(server, "PUBSUB_RETRY_DELAY", 0.01)
+
+    async def run():
+        worker, other_worker = await start_workers(fakeredis.FakeServer())
+        alice = FakeWebSocket()
+        await worker.connect(alice, "s1", "alice")
+        await asyncio.sleep(0.1)
+
+        await other_worker.broadcast("s1", {"type": "cursor_update", "userId": "bob"})
+        await asyncio.sleep(0.1)
+        assert "cursor_update" in alice.types()
+        await stop_workers([worker, other_worker])
+
+    asyncio.run(run())